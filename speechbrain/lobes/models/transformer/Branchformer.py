@@ -9,10 +9,13 @@ Authors
 * Titouan Parcollet 2023
 """
 
+from functools import partial
 from typing import Optional
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from speechbrain.lobes.models.convolution import ConvolutionalSpatialGatingUnit
 from speechbrain.nnet.attention import MultiheadAttention, RelPosMHAXL
@@ -88,6 +91,38 @@ class ConvolutionBranch(nn.Module):
 
         return x
 
+    def quantize_for_inference(self):
+        """Replaces pre_channel_proj and post_channel_proj, the largest
+        matmuls of the branch, with dynamically quantized int8 linear layers.
+        Weights are quantized once with per-output-channel scales while
+        activations are quantized on the fly, hence no calibration is needed.
+
+        This is meant for CPU inference only: it has to be called once the
+        weights are loaded, and the quantized module cannot be trained.
+
+        Example
+        -------
+        >>> x = torch.rand((8, 60, 512))
+        >>> net = ConvolutionBranch(512, 1024).eval()
+        >>> net.quantize_for_inference()
+        >>> output = net(x)
+        >>> output.shape
+        torch.Size([8, 60, 512])
+        """
+        if self.training:
+            raise ValueError(
+                "quantize_for_inference() is only supported in eval mode, "
+                "please call .eval() first."
+            )
+
+        qconfig = torch.ao.quantization.per_channel_dynamic_qconfig
+        torch.ao.quantization.quantize_dynamic(
+            self,
+            {"pre_channel_proj": qconfig, "post_channel_proj": qconfig},
+            dtype=torch.qint8,
+            inplace=True,
+        )
+
 
 class BranchformerEncoderLayer(nn.Module):
     """This is an implementation of Branchformer encoder layer.
@@ -116,6 +151,9 @@ class BranchformerEncoderLayer(nn.Module):
          Activation function used at the gate of the CSGU module.
     use_linear_after_conv: bool, optional
         If True, will apply a linear transformation of size input_size//2
+    num_kv_heads: int, optional
+        Number of key and value heads for grouped-query attention, only
+        supported with RelPosMHAXL. Default is nhead.
 
     Example
     -------
@@ -141,9 +179,18 @@ class BranchformerEncoderLayer(nn.Module):
         csgu_linear_units=3072,
         gate_activation=nn.Identity,
         use_linear_after_conv=False,
+        num_kv_heads=None,
     ):
         super().__init__()
 
+        self.attention_type = attention_type
+
+        if num_kv_heads is not None and attention_type != "RelPosMHAXL":
+            raise ValueError(
+                "num_kv_heads is only supported with the RelPosMHAXL attention "
+                f"type, got {attention_type}."
+            )
+
         if attention_type == "regularMHA":
             self.mha_layer = MultiheadAttention(
                 nhead=nhead,
@@ -159,6 +206,7 @@ class BranchformerEncoderLayer(nn.Module):
                 embed_dim=d_model,
                 dropout=dropout,
                 mask_pos_future=False,
+                num_kv_heads=num_kv_heads,
             )
         elif attention_type == "hypermixing":
             self.mha_layer = HyperMixing(
@@ -191,6 +239,8 @@ class BranchformerEncoderLayer(nn.Module):
         src_mask: Optional[torch.Tensor] = None,
         src_key_padding_mask: Optional[torch.Tensor] = None,
         pos_embs: Optional[torch.Tensor] = None,
+        return_attn_weights: bool = False,
+        sdpa_mask: Optional[torch.Tensor] = None,
     ):
         """
         Arguments
@@ -203,6 +253,12 @@ class BranchformerEncoderLayer(nn.Module):
             The mask for the src keys per batch.
         pos_embs: torch.Tensor, torch.nn.Module, optional
             Module or tensor containing the input sequence positional embeddings
+        return_attn_weights: bool, optional
+            Whether to compute and return the attention weights.
+        sdpa_mask: torch.Tensor, optional
+            Mask already built from src_mask and src_key_padding_mask with
+            _make_sdpa_mask, e.g. once for all the layers. Only used by the
+            scaled_dot_product_attention path.
         """
 
         # Two branches!
@@ -210,29 +266,280 @@ class BranchformerEncoderLayer(nn.Module):
         x2 = x
 
         # Branch 1: Self-attention
-        x1 = self.norm_mhsa(x1)
-        x1, self_attn = self.mha_layer(
+        x1, self_attn = self._forward_mha_branch(
             x1,
-            x1,
-            x1,
-            attn_mask=src_mask,
-            key_padding_mask=src_key_padding_mask,
+            src_mask=src_mask,
+            src_key_padding_mask=src_key_padding_mask,
             pos_embs=pos_embs,
+            return_attn_weights=return_attn_weights,
+            sdpa_mask=sdpa_mask,
         )
-        x1 = self.dropout(x1)
 
         # Branch 2: Convolutional gating MLP
-        # In ESPnet, masks are not used?! we do the same but warning!
-        x2 = self.norm_conv(x2)
-        x2 = self.convolution_branch(x2)
-        x2 = self.dropout(x2)
+        x2 = self._forward_cnn_branch(x2)
 
         # Merge both branches, we only do concatenation as it performs better.
         # According to the original Branchformer paper.
-        x = x + self.dropout(self.merge_proj(torch.cat([x1, x2], dim=-1)))
+        merged = self._apply_dropout(self._merge_branches(x1, x2))
+        if not torch.is_grad_enabled() and merged.dtype == x.dtype:
+            # Without autograd, the residual is added in the merged tensor
+            # rather than in a newly allocated one.
+            x = merged.add_(x)
+        else:
+            x = x + merged
 
         return x, self_attn
 
+    def _forward_mha_branch(
+        self,
+        x,
+        src_mask: Optional[torch.Tensor] = None,
+        src_key_padding_mask: Optional[torch.Tensor] = None,
+        pos_embs: Optional[torch.Tensor] = None,
+        return_attn_weights: bool = False,
+        sdpa_mask: Optional[torch.Tensor] = None,
+    ):
+        """Computes the self-attention branch of the layer.
+
+        For regularMHA, the attention is computed with
+        torch.nn.functional.scaled_dot_product_attention when available and
+        when the attention weights are not requested, so that fused (Flash /
+        memory-efficient) kernels can be used and the full attention matrix is
+        never materialized.
+
+        Arguments
+        ---------
+        x : torch.Tensor
+            The sequence to the encoder layer.
+        src_mask : torch.Tensor, optional
+            The mask for the src sequence.
+        src_key_padding_mask : torch.Tensor, optional
+            The mask for the src keys per batch.
+        pos_embs: torch.Tensor, torch.nn.Module, optional
+            Module or tensor containing the input sequence positional embeddings
+        return_attn_weights: bool, optional
+            Whether to compute and return the attention weights.
+        sdpa_mask: torch.Tensor, optional
+            Mask already built from src_mask and src_key_padding_mask with
+            _make_sdpa_mask, e.g. once for all the layers. Only used by the
+            scaled_dot_product_attention path.
+
+        Returns
+        -------
+        x : torch.Tensor
+            The output of the self-attention branch.
+        self_attn : torch.Tensor
+            The attention weights, None if they are not requested.
+        """
+        x = self.norm_mhsa(x)
+
+        if (
+            self.attention_type == "regularMHA"
+            and not return_attn_weights
+            and pos_embs is None
+            and hasattr(F, "scaled_dot_product_attention")
+        ):
+            if sdpa_mask is None:
+                sdpa_mask = _make_sdpa_mask(
+                    src_mask, src_key_padding_mask, self.mha_layer.att.num_heads
+                )
+            x = self._sdpa(x, sdpa_mask=sdpa_mask)
+            return self._apply_dropout(x), None
+
+        x = self.mha_layer(
+            x,
+            x,
+            x,
+            attn_mask=src_mask,
+            key_padding_mask=src_key_padding_mask,
+            pos_embs=pos_embs,
+            return_attn_weights=return_attn_weights,
+        )
+
+        self_attn = None
+        if return_attn_weights:
+            x, self_attn = x
+        elif isinstance(x, tuple):
+            # HyperMixing always returns its (dummy) attention weights
+            x = x[0]
+
+        return self._apply_dropout(x), self_attn
+
+    def _forward_cnn_branch(self, x):
+        """Computes the convolutional gating MLP branch of the layer.
+
+        Arguments
+        ---------
+        x : torch.Tensor
+            The sequence to the encoder layer.
+
+        Returns
+        -------
+        x : torch.Tensor
+            The output of the convolution branch.
+        """
+        # In ESPnet, masks are not used?! we do the same but warning!
+        x = self.norm_conv(x)
+        x = self.convolution_branch(x)
+
+        return self._apply_dropout(x)
+
+    def _apply_dropout(self, x):
+        """Applies the layer dropout, without going through the nn.Dropout
+        call at all when it is inactive (eval mode or p=0).
+
+        Arguments
+        ---------
+        x : torch.Tensor
+            The tensor to apply dropout on.
+
+        Returns
+        -------
+        x : torch.Tensor
+            The tensor after dropout.
+        """
+        if self.training and self.dropout.p > 0.0:
+            return self.dropout(x)
+        return x
+
+    def _merge_branches(self, x1, x2):
+        """Applies merge_proj to the concatenation of both branches without
+        allocating the concatenated tensor, i.e. W.[x1; x2] + b is computed as
+        W[:, :D].x1 + W[:, D:].x2 + b, the second product being accumulated
+        in the first one by the GEMM.
+
+        This is only done when merge_proj is a plain nn.Linear, otherwise
+        (e.g. quantized or wrapped by an adapter) it is applied to the
+        concatenation. Under autocast, the first product is rounded to the
+        lower precision before the second one is added, hence the result may
+        slightly differ from the single GEMM on the concatenation.
+
+        Arguments
+        ---------
+        x1 : torch.Tensor
+            (B, T, D) output of the self-attention branch.
+        x2 : torch.Tensor
+            (B, T, D) output of the convolution branch.
+
+        Returns
+        -------
+        out : torch.Tensor
+            (B, T, D) merged branches.
+        """
+        if type(self.merge_proj) is not nn.Linear:
+            return self.merge_proj(torch.cat([x1, x2], dim=-1))
+
+        weight_1, weight_2 = self.merge_proj.weight.chunk(2, dim=-1)
+        out = F.linear(x1, weight_1, self.merge_proj.bias)
+        # In-place ops are not handled by autocast, hence the explicit casts
+        out.flatten(0, -2).addmm_(
+            x2.flatten(0, -2).to(out.dtype), weight_2.t().to(out.dtype)
+        )
+
+        return out.view_as(x1)
+
+    def _sdpa(self, x, sdpa_mask: Optional[torch.Tensor] = None):
+        """Self-attention with scaled_dot_product_attention. The parameters of
+        the wrapped torch.nn.MultiheadAttention are used as is, hence
+        checkpoints are shared with the regular path.
+
+        Arguments
+        ---------
+        x : torch.Tensor
+            (B, T, E) input sequence (already normalized).
+        sdpa_mask : torch.Tensor, optional
+            Mask broadcastable to (B, num_heads, T, T), as built by
+            _make_sdpa_mask.
+
+        Returns
+        -------
+        out : torch.Tensor
+            (B, T, E) output of the attention.
+        """
+        att = self.mha_layer.att
+        bsz, seq_len, _ = x.shape
+
+        # single (E, 3E) projection -> 3 x (B, H, T, E // H)
+        query, key, value = (
+            F.linear(x, att.in_proj_weight, att.in_proj_bias)
+            .view(bsz, seq_len, 3, att.num_heads, att.head_dim)
+            .permute(2, 0, 3, 1, 4)
+        )
+
+        if sdpa_mask is not None and sdpa_mask.dtype != torch.bool:
+            sdpa_mask = sdpa_mask.to(query.dtype)
+
+        x = F.scaled_dot_product_attention(
+            query,
+            key,
+            value,
+            attn_mask=sdpa_mask,
+            dropout_p=att.dropout if self.training else 0.0,
+        )
+        x = x.transpose(1, 2).reshape(bsz, seq_len, -1)
+
+        return att.out_proj(x)
+
+
+def _make_sdpa_mask(attn_mask, key_padding_mask, num_heads):
+    """Merges MultiheadAttention-style masks into a single mask for
+    scaled_dot_product_attention. Boolean (or byte) masks stay boolean, with
+    the SDPA convention of True where attention is allowed, so that nothing
+    larger than the given masks is allocated. Float masks are additive.
+
+    Arguments
+    ---------
+    attn_mask : torch.Tensor, optional
+        2D mask (L, S) or 3D mask (B * num_heads, L, S), see
+        MultiheadAttention for the details.
+    key_padding_mask : torch.Tensor, optional
+        (B, S) mask where the padded positions are True (or additive if float).
+    num_heads : int
+        Number of attention heads.
+
+    Returns
+    -------
+    mask : torch.Tensor
+        Mask broadcastable to (B, num_heads, L, S), None if no mask is given.
+    """
+    mask = None
+    if attn_mask is not None:
+        if attn_mask.ndim == 3:
+            attn_mask = attn_mask.view(-1, num_heads, *attn_mask.shape[-2:])
+        if attn_mask.dtype in (torch.bool, torch.uint8):
+            mask = ~attn_mask.bool()
+        else:
+            mask = attn_mask
+
+    if key_padding_mask is not None:
+        key_padding_mask = key_padding_mask.view(
+            key_padding_mask.shape[0], 1, 1, -1
+        )
+        if key_padding_mask.dtype in (torch.bool, torch.uint8):
+            padding_mask = ~key_padding_mask.bool()
+        else:
+            padding_mask = key_padding_mask
+
+        if mask is None:
+            mask = padding_mask
+        elif mask.dtype == torch.bool and padding_mask.dtype == torch.bool:
+            mask = mask & padding_mask
+        else:
+            mask = _to_additive_mask(mask) + _to_additive_mask(padding_mask)
+
+    return mask
+
+
+def _to_additive_mask(mask):
+    """Converts a boolean mask where True values are allowed into an additive
+    float mask. Float masks are returned as is.
+    """
+    if mask.dtype == torch.bool:
+        return torch.zeros(mask.shape, device=mask.device).masked_fill_(
+            ~mask, float("-inf")
+        )
+    return mask
+
 
 class BranchformerEncoder(nn.Module):
     """This class implements the Branchformer encoder.
@@ -267,6 +574,21 @@ class BranchformerEncoder(nn.Module):
         Whether the model should output the hidden states as a list of tensor.
     layerdrop_prob: float
         The probability to drop an entire layer.
+    compile_encoder: bool, optional
+        If True, the whole encoder is compiled with torch.compile, as a single
+        graph specialized on the input shapes. The graph can only be captured
+        in full without layerdrop, otherwise graph breaks are allowed.
+    gradient_checkpointing: bool, optional
+        If True, the activations of each layer are recomputed during the
+        backward pass instead of being stored, trading compute for memory at
+        training time.
+    return_attn_weights: bool, optional
+        Whether the attention weights of each layer should be computed and
+        returned. Otherwise, the returned attention list is empty and faster
+        attention kernels may be used.
+    num_kv_heads: int, optional
+        Number of key and value heads for grouped-query attention, only
+        supported with RelPosMHAXL. Default is nhead.
 
 
     Example
@@ -306,6 +628,10 @@ class BranchformerEncoder(nn.Module):
         use_linear_after_conv=False,
         output_hidden_states=False,
         layerdrop_prob=0.0,
+        compile_encoder=False,
+        gradient_checkpointing=False,
+        return_attn_weights=False,
+        num_kv_heads=None,
     ):
         super().__init__()
 
@@ -323,6 +649,7 @@ class BranchformerEncoder(nn.Module):
                     csgu_linear_units=csgu_linear_units,
                     gate_activation=gate_activation,
                     use_linear_after_conv=use_linear_after_conv,
+                    num_kv_heads=num_kv_heads,
                 )
                 for i in range(num_layers)
             ]
@@ -331,6 +658,21 @@ class BranchformerEncoder(nn.Module):
         self.layerdrop_prob = layerdrop_prob
         self.attention_type = attention_type
         self.output_hidden_states = output_hidden_states
+        self.gradient_checkpointing = gradient_checkpointing
+        self.return_attn_weights = return_attn_weights
+
+        if compile_encoder:
+            if not hasattr(nn.Module, "compile"):
+                raise ValueError(
+                    "'compile_encoder' specified, but this install of PyTorch "
+                    "seems to be too old to support it."
+                )
+            # Compiles in place, so that the state_dict keys are unchanged.
+            self.compile(
+                dynamic=False,
+                fullgraph=layerdrop_prob == 0.0,
+                mode="max-autotune",
+            )
 
     def forward(
         self,
@@ -361,7 +703,7 @@ class BranchformerEncoder(nn.Module):
         output : torch.Tensor
             The output of the Conformer.
         attention_lst : list
-            The attention values.
+            The attention values, empty unless return_attn_weights is True.
         hidden_state_lst : list, optional
             The output of the hidden layers of the encoder.
             Only works if output_hidden_states is set to true.
@@ -378,26 +720,55 @@ class BranchformerEncoder(nn.Module):
 
         output = src
 
-        if self.layerdrop_prob > 0.0:
-            keep_probs = torch.rand(len(self.layers))
+        # All the layer drop decisions are taken at once, on the host, so
+        # that the loop below does not have to index a tensor for each layer.
+        if self.training and self.layerdrop_prob > 0.0:
+            keep_layers = (
+                torch.rand(len(self.layers)) > self.layerdrop_prob
+            ).tolist()
+        else:
+            keep_layers = [True] * len(self.layers)
 
         attention_lst = []
         if self.output_hidden_states:
             hidden_state_lst = [output]
 
-        for i, enc_layer in enumerate(self.layers):
-            if (
-                not self.training
-                or self.layerdrop_prob == 0.0
-                or keep_probs[i] > self.layerdrop_prob
-            ):
-                output, attention = enc_layer(
+        # The scaled_dot_product_attention mask is built once for all layers
+        sdpa_mask = None
+        if (
+            self.attention_type == "regularMHA"
+            and pos_embs is None
+            and not self.return_attn_weights
+        ):
+            sdpa_mask = (
+                _make_sdpa_mask(
+                    src_mask,
+                    src_key_padding_mask,
+                    self.layers[0].mha_layer.att.num_heads,
+                )
+                if len(self.layers) > 0
+                else None
+            )
+
+        for enc_layer, keep_layer in zip(self.layers, keep_layers):
+            if keep_layer:
+                layer_fn = enc_layer
+                if self.training and self.gradient_checkpointing:
+                    # Only the layer inputs are stored for the backward
+                    layer_fn = partial(
+                        checkpoint, enc_layer, use_reentrant=False
+                    )
+
+                output, attention = layer_fn(
                     output,
                     src_mask=src_mask,
                     src_key_padding_mask=src_key_padding_mask,
                     pos_embs=pos_embs,
+                    return_attn_weights=self.return_attn_weights,
+                    sdpa_mask=sdpa_mask,
                 )
-                attention_lst.append(attention)
+                if self.return_attn_weights:
+                    attention_lst.append(attention)
 
                 if self.output_hidden_states:
                     hidden_state_lst.append(output)
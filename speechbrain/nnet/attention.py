@@ -439,6 +439,15 @@ class RelPosMHAXL(nn.Module):
     mask_pos_future: bool, optional
         Whether to mask future positional encodings values.
         Must be true for causal applications e.g. decoder.
+    num_kv_heads: int, optional
+        Number of key and value heads. If smaller than num_heads, grouped-query
+        attention is used, i.e. each key/value head is shared by
+        num_heads // num_kv_heads query heads. Default is num_heads.
+        NOTE: with grouped key/value heads, in_proj_weight is always split as
+        [q; k; v] blocks, while the default self-attention path splits it per
+        head (q, k and v rows of each head being contiguous). Hence, a model
+        with num_kv_heads set cannot simply be loaded into or converted from a
+        standard RelPosMHAXL checkpoint.
 
     Example
     -------
@@ -448,6 +457,11 @@ class RelPosMHAXL(nn.Module):
     >>> outputs, attn = net(inputs, inputs, inputs, pos_emb)
     >>> outputs.shape
     torch.Size([6, 60, 512])
+
+    >>> net = RelPosMHAXL(num_heads=8, embed_dim=512, num_kv_heads=2)
+    >>> outputs, attn = net(inputs, inputs, inputs, pos_emb)
+    >>> outputs.shape
+    torch.Size([6, 60, 512])
     """
 
     def __init__(
@@ -458,6 +472,7 @@ class RelPosMHAXL(nn.Module):
         vbias=False,
         vdim=None,
         mask_pos_future=False,
+        num_kv_heads=None,
     ):
         super().__init__()
         self.embed_dim = embed_dim
@@ -467,6 +482,9 @@ class RelPosMHAXL(nn.Module):
         self.vbias = vbias
 
         self.num_heads = num_heads
+        self.num_kv_heads = (
+            num_kv_heads if num_kv_heads is not None else num_heads
+        )
         self.dropout = dropout
         self.head_dim = embed_dim // num_heads
         self.vhead_dim = self.vdim // num_heads
@@ -477,6 +495,12 @@ class RelPosMHAXL(nn.Module):
         assert (
             self.vhead_dim * num_heads == self.vdim
         ), "vdim must be divisible by num_heads"
+        assert (
+            num_heads % self.num_kv_heads == 0
+        ), "num_heads must be divisible by num_kv_heads"
+        assert (
+            self.num_kv_heads == num_heads or self._qkv_same_embed_dim
+        ), "num_kv_heads requires vdim to be equal to embed_dim"
 
         if self._qkv_same_embed_dim is False:
             self.qk_proj_weight = nn.Parameter(
@@ -484,12 +508,15 @@ class RelPosMHAXL(nn.Module):
             )
             self.v_proj_weight = nn.Parameter(torch.empty(self.vdim, embed_dim))
         else:
+            kv_dim = self.num_kv_heads * self.head_dim
             self.in_proj_weight = nn.Parameter(
-                torch.empty(3 * embed_dim, embed_dim)
+                torch.empty(embed_dim + 2 * kv_dim, embed_dim)
             )
 
         if vbias:
-            self.value_bias_weight = nn.Parameter(torch.empty(self.vdim))
+            self.value_bias_weight = nn.Parameter(
+                torch.empty(self.num_kv_heads * self.vhead_dim)
+            )
         else:
             self.vbias = None
 
@@ -527,6 +554,51 @@ class RelPosMHAXL(nn.Module):
         torch.nn.init.xavier_uniform_(self.pos_bias_u)
         torch.nn.init.xavier_uniform_(self.pos_bias_v)
 
+    def _grouped_in_proj(self, query, key, value):
+        """Projects the query, key and value for grouped-query attention,
+        where key and value have num_kv_heads heads only.
+
+        Arguments
+        ---------
+        query : torch.Tensor
+            (B, L, E) query sequence.
+        key : torch.Tensor
+            (B, S, E) key sequence.
+        value : torch.Tensor
+            (B, S, E) value sequence.
+
+        Returns
+        -------
+        query : torch.Tensor
+            (B, L, num_heads, head_dim) projected query.
+        key : torch.Tensor
+            (B, S, num_kv_heads, head_dim) projected key.
+        value : torch.Tensor
+            (B, S, num_kv_heads, head_dim) projected value.
+        """
+        bsz = query.shape[0]
+        kv_dim = self.num_kv_heads * self.head_dim
+        split_sizes = [self.embed_dim, kv_dim, kv_dim]
+
+        if (query is key or torch.equal(query, key)) and (
+            key is value or torch.equal(key, value)
+        ):
+            # self-attention
+            query, key, value = nn.functional.linear(
+                query, self.in_proj_weight
+            ).split(split_sizes, dim=-1)
+        else:
+            qweight, kweight, vweight = self.in_proj_weight.split(split_sizes)
+            query = nn.functional.linear(query, qweight)
+            key = nn.functional.linear(key, kweight)
+            value = nn.functional.linear(value, vweight)
+
+        query = query.view(bsz, -1, self.num_heads, self.head_dim)
+        key = key.view(bsz, -1, self.num_kv_heads, self.head_dim)
+        value = value.view(bsz, -1, self.num_kv_heads, self.head_dim)
+
+        return query, key, value
+
     def rel_shift(self, x):
         """Relative shift implementation."""
         # batch, head, time1, 2*time1-1.
@@ -607,7 +679,9 @@ class RelPosMHAXL(nn.Module):
         klen = key.shape[1]
         qlen = query.shape[1]
 
-        if self._qkv_same_embed_dim:
+        if self.num_kv_heads != self.num_heads:
+            query, key, value = self._grouped_in_proj(query, key, value)
+        elif self._qkv_same_embed_dim:
             # self-attention
             if (query is key or torch.equal(query, key)) and (
                 key is value or torch.equal(key, value)
@@ -641,9 +715,15 @@ class RelPosMHAXL(nn.Module):
 
         if self.vbias is not None:
             value = value + self.value_bias_weight.view(
-                1, 1, self.num_heads, self.vhead_dim
+                1, 1, self.num_kv_heads, self.vhead_dim
             )
 
+        if self.num_kv_heads != self.num_heads:
+            # grouped-query attention, share each key/value head
+            num_groups = self.num_heads // self.num_kv_heads
+            key = key.repeat_interleave(num_groups, dim=2)
+            value = value.repeat_interleave(num_groups, dim=2)
+
         p_k = self.linear_pos(pos_embs).view(
             1, -1, self.num_heads, self.head_dim
         )
@@ -25,3 +25,71 @@ def test_rel_pos_MHA(device):
                         (1, 2 * kl - 1, emb_dim), device=device
                     )
                     relpos(q, k, k, pos_embs=pos_embs)
+
+
+@torch.no_grad
+def test_rel_pos_MHA_grouped_query(device):
+    """Test whether RelPosMHAXL with grouped key/value heads is equivalent to
+    a full-head RelPosMHAXL whose key/value weights are repeated per group.
+    """
+    from speechbrain.nnet.attention import RelPosMHAXL
+
+    TOLERATED_MAX_ERROR = 1.0e-5
+
+    torch.manual_seed(1337)
+
+    bsz, seq_len, emb_dim = 2, 7, 16
+    num_heads, num_kv_heads = 4, 2
+    head_dim = emb_dim // num_heads
+    num_groups = num_heads // num_kv_heads
+
+    grouped = RelPosMHAXL(
+        emb_dim, num_heads=num_heads, vbias=True, num_kv_heads=num_kv_heads
+    ).to(device)
+    full = RelPosMHAXL(emb_dim, num_heads=num_heads, vbias=True).to(device)
+    grouped.eval()
+    full.eval()
+
+    for name in ["out_proj", "linear_pos"]:
+        getattr(full, name).load_state_dict(getattr(grouped, name).state_dict())
+    full.pos_bias_u.copy_(grouped.pos_bias_u)
+    full.pos_bias_v.copy_(grouped.pos_bias_v)
+
+    # grouped in_proj_weight is laid out as [q; k; v] blocks
+    kv_dim = num_kv_heads * head_dim
+    q_weight, k_weight, v_weight = grouped.in_proj_weight.split(
+        [emb_dim, kv_dim, kv_dim]
+    )
+
+    def repeat_heads(tensor):
+        heads = tensor.view(num_kv_heads, head_dim, *tensor.shape[1:])
+        return heads.repeat_interleave(num_groups, dim=0).reshape(
+            emb_dim, *tensor.shape[1:]
+        )
+
+    k_weight, v_weight = repeat_heads(k_weight), repeat_heads(v_weight)
+    full.value_bias_weight.copy_(repeat_heads(grouped.value_bias_weight))
+
+    x = torch.rand((bsz, seq_len, emb_dim), device=device)
+    y = torch.rand((bsz, seq_len, emb_dim), device=device)
+    pos_embs = torch.rand((1, 2 * seq_len - 1, emb_dim), device=device)
+
+    # the self-attention path of the full-head module splits per head
+    full.in_proj_weight.copy_(
+        torch.stack(
+            [
+                weight.view(num_heads, head_dim, emb_dim)
+                for weight in (q_weight, k_weight, v_weight)
+            ],
+            dim=1,
+        ).reshape(3 * emb_dim, emb_dim)
+    )
+    out_grouped, _ = grouped(x, x, x, pos_embs)
+    out_full, _ = full(x, x, x, pos_embs)
+    assert (out_grouped - out_full).abs().max().item() < TOLERATED_MAX_ERROR
+
+    # while its cross-attention path splits [q; k; v] blocks
+    full.in_proj_weight.copy_(torch.cat([q_weight, k_weight, v_weight]))
+    out_grouped, _ = grouped(x, y, y, pos_embs)
+    out_full, _ = full(x, y, y, pos_embs)
+    assert (out_grouped - out_full).abs().max().item() < TOLERATED_MAX_ERROR
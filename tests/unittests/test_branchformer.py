@@ -0,0 +1,322 @@
+import torch
+
+
+@torch.no_grad
+def test_branchformer_sdpa_matches_mha(device):
+    """Test whether the scaled_dot_product_attention path of the Branchformer
+    regularMHA branch is equivalent to the MultiheadAttention one.
+    """
+    from speechbrain.lobes.models.transformer.Branchformer import (
+        BranchformerEncoder,
+        BranchformerEncoderLayer,
+        _make_sdpa_mask,
+    )
+
+    TOLERATED_MAX_ERROR = 1.0e-5
+
+    torch.manual_seed(1337)
+
+    module = BranchformerEncoderLayer(
+        d_model=16, nhead=4, kernel_size=3, attention_type="regularMHA"
+    ).to(device=device)
+    module.eval()
+
+    bs, seq_len, num_feats = 3, 10, 16
+    test_input = torch.randn((bs, seq_len, num_feats), device=device)
+    src_key_padding_mask = torch.zeros(
+        (bs, seq_len), dtype=torch.bool, device=device
+    )
+    src_key_padding_mask[1, 7:] = True
+    causal_mask = torch.triu(
+        torch.ones((seq_len, seq_len), dtype=torch.bool, device=device), 1
+    )
+    # (B * H, T, T) mask, different for every head
+    head_mask = torch.rand((bs * 4, seq_len, seq_len), device=device) < 0.3
+    head_mask[..., 0] = False
+
+    mask_cases = [
+        (None, None),
+        (causal_mask, None),
+        (None, src_key_padding_mask),
+        (causal_mask, src_key_padding_mask),
+        (head_mask, None),
+        (head_mask, src_key_padding_mask),
+        (torch.randn((seq_len, seq_len), device=device), None),
+        (torch.randn((seq_len, seq_len), device=device), src_key_padding_mask),
+        (torch.randn((bs * 4, seq_len, seq_len), device=device), None),
+    ]
+
+    x = module.norm_mhsa(test_input)
+    for src_mask, key_padding_mask in mask_cases:
+        sdpa_mask = _make_sdpa_mask(src_mask, key_padding_mask, num_heads=4)
+        if src_mask is not None and src_mask.dtype == torch.bool:
+            # boolean masks are not turned into (B, 1, T, T) float masks
+            assert sdpa_mask.dtype == torch.bool
+        out_sdpa = module._sdpa(x, sdpa_mask=sdpa_mask)
+        out_mha, _attn = module.mha_layer(
+            x,
+            x,
+            x,
+            attn_mask=src_mask,
+            key_padding_mask=key_padding_mask,
+        )
+
+        abs_diff = (out_sdpa - out_mha).abs()
+
+        assert torch.max(abs_diff).item() < TOLERATED_MAX_ERROR
+
+    # the mask built once by the encoder gives the same output as the
+    # layers building it themselves
+    encoder = BranchformerEncoder(
+        num_layers=2,
+        d_model=16,
+        nhead=4,
+        kernel_size=3,
+        attention_type="regularMHA",
+    ).to(device=device)
+    encoder.eval()
+    out, _attn = encoder(
+        test_input,
+        src_mask=causal_mask,
+        src_key_padding_mask=src_key_padding_mask,
+    )
+    out_ref = test_input
+    for layer in encoder.layers:
+        out_ref, _attn = layer(
+            out_ref,
+            src_mask=causal_mask,
+            src_key_padding_mask=src_key_padding_mask,
+        )
+    out_ref = encoder.norm(out_ref)
+
+    assert torch.max((out - out_ref).abs()).item() < TOLERATED_MAX_ERROR
+
+
+@torch.no_grad
+def test_branchformer_merge_matches_concat(device):
+    """Test whether merging the Branchformer branches without concatenation
+    gives the same result as merge_proj applied to the concatenation.
+    """
+    from speechbrain.lobes.models.transformer.Branchformer import (
+        BranchformerEncoderLayer,
+    )
+
+    TOLERATED_MAX_ERROR = 1.0e-5
+
+    torch.manual_seed(1337)
+
+    module = BranchformerEncoderLayer(d_model=16, nhead=4, kernel_size=3).to(
+        device=device
+    )
+
+    x1 = torch.randn((3, 10, 16), device=device)
+    x2 = torch.randn((3, 10, 16), device=device)
+
+    out_split = module._merge_branches(x1, x2)
+    out_concat = module.merge_proj(torch.cat([x1, x2], dim=-1))
+
+    abs_diff = (out_split - out_concat).abs()
+
+    assert torch.max(abs_diff).item() < TOLERATED_MAX_ERROR
+
+
+def test_branchformer_gradient_checkpointing(device):
+    """Test whether gradient checkpointing gives the same outputs and
+    gradients as the regular training forward of the Branchformer encoder.
+    """
+    from speechbrain.lobes.models.transformer.Branchformer import (
+        BranchformerEncoder,
+    )
+    from speechbrain.nnet.attention import RelPosEncXL
+
+    TOLERATED_MAX_ERROR = 1.0e-5
+
+    torch.manual_seed(1337)
+
+    module = BranchformerEncoder(
+        num_layers=2, d_model=16, nhead=4, kernel_size=3, dropout=0.1
+    ).to(device=device)
+    module_ckpt = BranchformerEncoder(
+        num_layers=2,
+        d_model=16,
+        nhead=4,
+        kernel_size=3,
+        dropout=0.1,
+        gradient_checkpointing=True,
+    ).to(device=device)
+    module_ckpt.load_state_dict(module.state_dict())
+
+    test_input = torch.randn((3, 10, 16), device=device)
+    pos_embs = RelPosEncXL(16).to(device=device)(test_input)
+
+    torch.manual_seed(1337)
+    out, _attn = module(test_input, pos_embs=pos_embs)
+    out.sum().backward()
+
+    torch.manual_seed(1337)
+    out_ckpt, _attn = module_ckpt(test_input, pos_embs=pos_embs)
+    out_ckpt.sum().backward()
+
+    assert torch.max((out - out_ckpt).abs()).item() < TOLERATED_MAX_ERROR
+    for param, param_ckpt in zip(module.parameters(), module_ckpt.parameters()):
+        abs_diff = (param.grad - param_ckpt.grad).abs()
+        assert torch.max(abs_diff).item() < TOLERATED_MAX_ERROR
+
+
+@torch.no_grad
+def test_branchformer_no_layers(device):
+    """Test whether a Branchformer encoder without layers only applies the
+    final normalization, also with RelPosMHAXL positional embeddings.
+    """
+    from speechbrain.lobes.models.transformer.Branchformer import (
+        BranchformerEncoder,
+    )
+    from speechbrain.nnet.attention import RelPosEncXL
+
+    torch.manual_seed(1337)
+
+    module = BranchformerEncoder(
+        num_layers=0, d_model=16, nhead=4, kernel_size=3
+    ).to(device=device)
+    module.eval()
+
+    test_input = torch.randn((2, 10, 16), device=device)
+    pos_embs = RelPosEncXL(16).to(device=device)(test_input)
+
+    out, attention_lst = module(test_input, pos_embs=pos_embs)
+
+    assert out.shape == (2, 10, 16)
+    assert torch.allclose(out, module.norm(test_input))
+    assert attention_lst == []
+
+
+@torch.no_grad
+def test_branchformer_wrapped_linear_pos(device):
+    """Test whether a RelPosMHAXL Branchformer encoder still runs once its
+    linear_pos layers are quantized or wrapped by an adapter.
+    """
+    from speechbrain.lobes.models.transformer.Branchformer import (
+        BranchformerEncoder,
+    )
+    from speechbrain.nnet.adapters import AdaptedModel, LoRA
+    from speechbrain.nnet.attention import RelPosEncXL
+
+    torch.manual_seed(1337)
+
+    test_input = torch.randn((2, 10, 16), device=device)
+    pos_embs = RelPosEncXL(16).to(device=device)(test_input)
+
+    module = BranchformerEncoder(
+        num_layers=2, d_model=16, nhead=4, kernel_size=3
+    ).to(device=device)
+    module.eval()
+    out, _attn = module(test_input, pos_embs=pos_embs)
+
+    lora_module = AdaptedModel(
+        module, LoRA, target_layers=["*linear_pos"], adapter_kwargs={"rank": 2}
+    )
+    lora_out, _attn = lora_module(test_input, pos_embs=pos_embs)
+    assert lora_out.shape == out.shape
+
+    if device == "cpu":
+        qconfig = torch.ao.quantization.default_dynamic_qconfig
+        quantized_module = torch.ao.quantization.quantize_dynamic(
+            module,
+            {
+                f"layers.{i}.mha_layer.linear_pos": qconfig
+                for i in range(len(module.layers))
+            },
+        )
+        quantized_out, _attn = quantized_module(test_input, pos_embs=pos_embs)
+        assert quantized_out.shape == out.shape
+
+
+@torch.no_grad
+def test_branchformer_wrapped_merge_proj(device):
+    """Test whether the Branchformer merge falls back to the concatenation
+    once merge_proj is quantized or wrapped by an adapter.
+    """
+    from speechbrain.lobes.models.transformer.Branchformer import (
+        BranchformerEncoderLayer,
+    )
+    from speechbrain.nnet.adapters import AdaptedModel, LoRA
+    from speechbrain.nnet.attention import RelPosEncXL
+
+    TOLERATED_MAX_ERROR = 1.0e-5
+
+    torch.manual_seed(1337)
+
+    test_input = torch.randn((2, 10, 16), device=device)
+    pos_embs = RelPosEncXL(16).to(device=device)(test_input)
+    x1 = torch.randn((2, 10, 16), device=device)
+    x2 = torch.randn((2, 10, 16), device=device)
+
+    module = BranchformerEncoderLayer(d_model=16, nhead=4, kernel_size=3).to(
+        device=device
+    )
+    module.eval()
+    out, _attn = module(test_input, pos_embs=pos_embs)
+
+    # LoRA starts as an identity, so the merge must be unchanged
+    lora_module = AdaptedModel(
+        module, LoRA, all_linear=True, adapter_kwargs={"rank": 2}
+    )
+    lora_out, _attn = lora_module(test_input, pos_embs=pos_embs)
+    assert torch.max((lora_out - out).abs()).item() < TOLERATED_MAX_ERROR
+    lora_merge = lora_module.adapted_model._merge_branches(x1, x2)
+    merge = module.merge_proj.pretrained_module(torch.cat([x1, x2], dim=-1))
+    assert torch.max((lora_merge - merge).abs()).item() < TOLERATED_MAX_ERROR
+
+    if device == "cpu":
+        for attention_type in ["regularMHA", "RelPosMHAXL"]:
+            module = BranchformerEncoderLayer(
+                d_model=16,
+                nhead=4,
+                kernel_size=3,
+                attention_type=attention_type,
+            ).eval()
+            quantized_module = torch.ao.quantization.quantize_dynamic(
+                module, {torch.nn.Linear}
+            )
+            assert not isinstance(quantized_module.merge_proj, torch.nn.Linear)
+            quantized_out, _attn = quantized_module(
+                test_input,
+                pos_embs=pos_embs if attention_type == "RelPosMHAXL" else None,
+            )
+            assert quantized_out.shape == test_input.shape
+
+
+@torch.no_grad
+def test_branchformer_quantize_for_inference():
+    """Test whether the dynamically quantized Branchformer convolution branch
+    stays close to the float one, and cannot be quantized in train mode.
+    """
+    import copy
+
+    import pytest
+
+    from speechbrain.lobes.models.transformer.Branchformer import (
+        ConvolutionBranch,
+    )
+
+    TOLERATED_MAX_ERROR = 5.0e-2
+
+    torch.manual_seed(1337)
+
+    module = ConvolutionBranch(16, linear_units=64, kernel_size=3)
+    with pytest.raises(ValueError):
+        module.quantize_for_inference()
+    assert isinstance(module.pre_channel_proj, torch.nn.Linear)
+
+    module.eval()
+    quantized_module = copy.deepcopy(module)
+    quantized_module.quantize_for_inference()
+
+    quantized_linear = torch.ao.nn.quantized.dynamic.Linear
+    assert isinstance(quantized_module.pre_channel_proj, quantized_linear)
+    assert isinstance(quantized_module.post_channel_proj, quantized_linear)
+
+    test_input = torch.randn((3, 10, 16))
+    abs_diff = (quantized_module(test_input) - module(test_input)).abs()
+
+    assert torch.max(abs_diff).item() < TOLERATED_MAX_ERROR